@@ -1,71 +1,182 @@
 import logging
-from typing import Dict
+import math
+from functools import lru_cache
+from typing import Dict, List
 from dataclasses import dataclass
 
 import numpy as np
+import shapely
 from filterpy.common import Q_discrete_white_noise
-from filterpy.kalman import KalmanFilter
+from numba import njit
 from shapely.geometry import LineString, Point, Polygon, box
 
 from geometry import *
 
 
-def F_matrix(dt):
+# Initial uncertainty of the state
+P0 = np.diag([1, 2, 400, 1, 2, 400]).astype(np.float32) * 10
+
+
+def Q_matrix(dt):
+    return Q_discrete_white_noise(dim=3, dt=dt, var=0.5e-1**2, block_size=2).astype(np.float32) # process uncertainty
+
+
+@njit(cache=True, fastmath=True)
+def inv2x2(S):
+    """
+    Closed form inverse of 2x2 matrix
+    """
+    a, b, c, d = S[0, 0], S[0, 1], S[1, 0], S[1, 1]
+    det = a * d - b * c
+    S_inv = np.empty_like(S)
+    S_inv[0, 0] = d / det
+    S_inv[0, 1] = -b / det
+    S_inv[1, 0] = -c / det
+    S_inv[1, 1] = a / det
+    return S_inv
+
+
+@njit(cache=True, fastmath=True)
+def kf_predict(x, P, dt, Q):
+    """
+    In-place Kalman filter predict of state x (6,1), P (6,6) with the constant acceleration model
+
+    The transition matrix F has only 6 off-diagonal elements so x = F x and
+    P = F P F' + Q are evaluated by row and column operations.
+    """
     dt2 = 0.5 * dt ** 2
-    return np.array(
-        [[1, dt, dt2, 0, 0, 0],
-         [0, 1, dt, 0, 0, 0],
-         [0, 0, 1, 0, 0, 0],
-         [0, 0, 0, 1, dt, dt2],
-         [0, 0, 0, 0, 1, dt],
-         [0, 0, 0, 0, 0, 1]], dtype=np.float32
-    )
-
-
-def object_tracker(x_init, dt: float = 1):
-    kf = KalmanFilter(dim_x=6, dim_z=2)
-    kf.F = F_matrix(dt)
-
-    kf.H = np.array(
-        [[1, 0, 0, 0, 0, 0],
-         [0, 0, 0, 1, 0, 0]]
-    )  # Measurement function
-
-    kf.P = np.diag([1, 2, 400, 1, 2, 400]) * 10
-    z_std = 2
-    kf.R = np.diag([z_std ** 2, z_std ** 2])  # 1 standard
-    kf.Q = Q_discrete_white_noise(dim=3, dt=dt, var=0.5e-1**2, block_size=2) # process uncertainty
-    kf._alpha_sq = 1
-    x, y = x_init
-    kf.x[0] = x
-    kf.x[3] = y
-    return kf
+    for i in range(0, 6, 3):
+        x[i, 0] += dt * x[i + 1, 0] + dt2 * x[i + 2, 0]
+        x[i + 1, 0] += dt * x[i + 2, 0]
+    for i in range(0, 6, 3):  # F P
+        for j in range(6):
+            P[i, j] += dt * P[i + 1, j] + dt2 * P[i + 2, j]
+            P[i + 1, j] += dt * P[i + 2, j]
+    for i in range(0, 6, 3):  # (F P) F'
+        for j in range(6):
+            P[j, i] += dt * P[j, i + 1] + dt2 * P[j, i + 2]
+            P[j, i + 1] += dt * P[j, i + 2]
+    P += Q
+
+
+@njit(cache=True, fastmath=True)
+def kf_predict_update_batched(means, covs, rows, z, dt, Q, R):
+    """
+    In-place Kalman filter predict and update of rows of means (N,6,1) and covs (N,6,6)
+    with measurements z (K,2,1) and their noise R (K,2,2)
+
+    The measurement function selects (x,y) from the state (x, vx, ax, y, vy, ay),
+    so products with H are replaced by picking rows and columns 0 and 3.
+    """
+    for k in range(rows.size):
+        x = means[rows[k]]
+        P = covs[rows[k]]
+        kf_predict(x, P, dt, Q)
+        # Innovation y = z - H x and its covariance S = H P H' + R
+        y0 = z[k, 0, 0] - x[0, 0]
+        y1 = z[k, 1, 0] - x[3, 0]
+        S = np.empty((2, 2), dtype=P.dtype)
+        S[0, 0] = P[0, 0] + R[k, 0, 0]
+        S[0, 1] = P[0, 3] + R[k, 0, 1]
+        S[1, 0] = P[3, 0] + R[k, 1, 0]
+        S[1, 1] = P[3, 3] + R[k, 1, 1]
+        S_inv = inv2x2(S)
+        # Gain K = P H' S^-1 (6,2)
+        K = np.empty((6, 2), dtype=P.dtype)
+        for i in range(6):
+            K[i, 0] = P[i, 0] * S_inv[0, 0] + P[i, 3] * S_inv[1, 0]
+            K[i, 1] = P[i, 0] * S_inv[0, 1] + P[i, 3] * S_inv[1, 1]
+            x[i, 0] += K[i, 0] * y0 + K[i, 1] * y1
+        # Joseph form P = (I - K H) P (I - K H)' + K R K' (as in filterpy) keeps the covariance well conditioned in float32
+        A = np.empty((6, 6), dtype=P.dtype)  # (I - K H) P
+        for i in range(6):
+            for j in range(6):
+                A[i, j] = P[i, j] - K[i, 0] * P[0, j] - K[i, 1] * P[3, j]
+        for i in range(6):
+            KR0 = K[i, 0] * R[k, 0, 0] + K[i, 1] * R[k, 1, 0]
+            KR1 = K[i, 0] * R[k, 0, 1] + K[i, 1] * R[k, 1, 1]
+            for j in range(6):
+                P[i, j] = A[i, j] - A[i, 0] * K[j, 0] - A[i, 3] * K[j, 1] + KR0 * K[j, 0] + KR1 * K[j, 1]
+
 
 def covariance(xy: np.ndarray, sigma: float = 0.1, scale: float = 0.1):
-    d = np.linalg.norm(xy)
-    x,y = xy
-    th = np.arctan2(y, x)
+    """
+    Measurement noise for points (...,2) - elongated in the direction from the camera
+    """
+    d = np.linalg.norm(xy, axis=-1)
+    th = np.arctan2(xy[..., 1], xy[..., 0])
     c, s = np.cos(th), np.sin(th)
-    M = np.array([[c, -s], [s, c]])
-    return M @ (np.diag([1, scale]) * sigma * d)
+    M = np.stack([np.stack([c, -s], axis=-1), np.stack([s, c], axis=-1)], axis=-2)
+    return M @ np.diag([1, scale]) * (sigma * d)[..., None, None]
+
+
+@lru_cache(maxsize=8)
+def path_coefficients(length: float, dt: float):
+    """
+    Coefficients (M,3) projecting (p, v, a) to positions at times 0, dt, ..., length
+
+    The result is cached and read-only.
+    """
+    ts = np.arange(0, length + dt, dt)
+    coefs = np.stack([np.ones_like(ts), ts, 0.5 * ts ** 2], axis=1).astype(np.float32)
+    coefs.flags.writeable = False
+    return coefs
+
+
+def future_paths(means: np.ndarray, coefs: np.ndarray, out: np.ndarray = None):
+    """
+    Future locations (N,M,2) of objects with states (N,6,1)
+
+    The locations are written to out (N,M,2) if given.
+    """
+    n, m = means.shape[0], coefs.shape[0]
+    if out is None:
+        out = np.empty((n, m, 2), dtype=np.float32)
+    pva = means.reshape(n, 2, 3).transpose(0, 2, 1)  # (N,3,2) position, velocity, acceleration of x and y
+    return np.matmul(coefs, pva, out=out)
+
 
 class PointWorldObject:
     """
     Simplest abstraction of world objects - just a location
 
-    One can implement 
+    The object does not own its state - it reads its row in the state arrays of
+    ForwardCollisionGuard which filters all objects at once. Values reflect the
+    last update of the guard. Once the object is lost, it has no state, location
+    or path and its distance is inf.
     """
 
-    def __init__(self, xyz: np.ndarray, dt: float):
-        self.kf = object_tracker(xyz[:2], dt=dt)
-        self.xy = None
-        self.vxvy = None
+    def __init__(self, guard: "ForwardCollisionGuard", tid: int):
+        self.guard = guard
+        self.tid = tid
+
+    @property
+    def row(self):
+        """
+        Row of the object in the state arrays, None if the object is lost
+        """
+        return self.guard.tid_to_row.get(self.tid)
+
+    @property
+    def x(self):
+        """
+        Copy of the state (6,1) - x, vx, ax, y, vy, ay
+        """
+        row = self.row
+        if row is None: return None
+        return self.guard.means[row].copy()
+
+    @property
+    def xy(self):
+        row = self.row
+        if row is None or not self.guard.updated[row]: return None
+        return self.guard.means[row, [0, 3], 0]
 
-    def update(self, location=None):
-        self.kf.predict()
-        self.kf.update(location, R=covariance(location, sigma=0.1, scale=0.1))
-        self.xy = np.dot(self.kf.H, self.kf.x).T[0]
-        self.vxvy = np.dot(np.array([[0, 1, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0]]), self.kf.x).T[0]
+    @property
+    def vxvy(self):
+        row = self.row
+        if row is None or not self.guard.updated[row]: return None
+        return self.guard.means[row, [1, 4], 0]
 
     @property
     def location(self):
@@ -73,63 +184,59 @@ class PointWorldObject:
 
     @property
     def distance(self):
-        if self.xy is None:
-            return np.inf
-        else:
-            return np.linalg.norm(self.xy)
+        row = self.row
+        if row is None: return np.inf
+        return float(self.guard.distances[row])
 
     @property
     def relative_speed(self):
-        if self.vxvy is None: return 0
-        return np.linalg.norm(self.vxvy)
-
-    def future_path(self, length: float = 1, dt: float = 0.1):
-        x = self.kf.x
-        F = F_matrix(dt)
-        t = 0
-        X = [x]
-        while t < length:
-            x = np.dot(F, x)
-            t += dt
-            X.append(x)
-        xy = self.kf.H @ np.hstack(X)  # (2, N)
-        return LineString(xy.T)
-
-
-def get_reference_points(trackers: dict, camera: Camera, *, is_rectified: bool):
+        vxvy = self.vxvy
+        if vxvy is None: return 0
+        return math.hypot(*vxvy)
+
+    def future_path_xy(self, length: float = 1, dt: float = 0.1):
+        """
+        Future locations (M,2) of the object, None if the object is lost
+        """
+        row = self.row
+        if row is None: return None
+        return future_paths(self.guard.means[row:row + 1], path_coefficients(length, dt))[0]
+
+    def future_path_line(self, length: float = 1, dt: float = 0.1):
+        xy = self.future_path_xy(length, dt)
+        if xy is None: return None
+        return LineString(xy)
+
+
+def get_reference_points(tids: list, boxes: np.ndarray, camera: Camera, *, is_rectified: bool):
     """
     Convert 2D observation to 3D
+
+    tids : list of N object ids
+    boxes : (N,4) image space bounding boxes of the objects (x1,y1,x2,y2)
     """
-    if not trackers: return dict()
+    if not tids: return dict()
 
-    # (xyxy) -> (rx,ry)
-    R = np.array(
-        [[0.5, 0, 0.5, 0],
-         [0, 0, 0, 1]],
-    )
-    # image space bounding boxes of objects
-    bb = np.vstack([tracker.get_state() for tracker in trackers.values()]).T
-    img_rp = R @ bb  # (2,N) 2D ref points in distorted image
+    # (xyxy) -> (rx,ry) 2D ref points - bottom center of boxes
+    img_rp = np.stack([0.5 * (boxes[:, 0] + boxes[:, 2]), boxes[:, 3]])  # (2,N)
 
     if not is_rectified:
         # If trackers are used on non-rectified image
         img_rp = camera.rectify_points(img_rp.T).T
 
-    # points are in cam.K_new camera - normalize and convert to (3,N)
+    # points are in cam.K_new camera - normalize and convert to homogeneous 3D (4,N)
     n = img_rp.shape[1]
-    img_rp_h = np.vstack([img_rp, np.ones((1, n))])
-    norm_rp = inv(camera.K_new) @ img_rp_h  # (3,N) normalized xyz in camera space
-
-    norm_rp = np.vstack([norm_rp, np.ones((1, n))])  # (4,N) homogeneous in 3D
+    norm_rp = np.ones((4, n))
+    norm_rp[:3] = camera.K_new_inv[:, :2] @ img_rp + camera.K_new_inv[:, 2:]
 
     X = camera.RT_inv @ norm_rp  # (3,N)
-    O = camera.RT_inv[:, -1].reshape(3, -1)
+    O = camera.RT_inv[:, -1:]  # (3,1)
     S = X - O
-    plane_normal = np.atleast_2d([0, 0, 1])
-    t = (plane_normal @ O[:3]) / (plane_normal @ S[:3])
+    # Intersection with z=0 plane
+    t = O[2] / S[2]
     world_rp = O - t * S
 
-    return dict(zip(trackers.keys(), world_rp.T))  # tid -> (x,y,z)
+    return dict(zip(tids, world_rp.T))  # tid -> (x,y,z)
 
 
 class ForwardCollisionGuard:
@@ -144,11 +251,57 @@ class ForwardCollisionGuard:
     ):
         self.dt = dt
         self.objects: Dict[int, PointWorldObject] = dict()
+        # State of all objects - rows of lost objects are reused for new ones
+        self.tid_to_row: Dict[int, int] = dict()
+        # Single precision is sufficient for the filter with the Joseph form covariance update
+        self.means = np.zeros((8, 6, 1), dtype=np.float32)  # (N,6,1)
+        self.covs = np.zeros((8, 6, 6), dtype=np.float32)  # (N,6,6)
+        self.updated = np.zeros(8, dtype=bool)  # (N,) Flag if object received a measurement
+        self.distances = np.full(8, np.inf, dtype=np.float32)  # (N,) Distance of objects, inf until measured
+        self.free_rows: List[int] = list(range(7, -1, -1))  # Stack of unused rows
         self.danger_zone = danger_zone
+        shapely.prepare(self.danger_zone)
+        # Index of individual regions of the zone (it may be a MultiPolygon)
+        self.zone_tree = shapely.STRtree(shapely.get_parts(danger_zone))
+        self.danger_zone_bounds = np.reshape(danger_zone.bounds, (2, 2))  # [[minx, miny], [maxx, maxy]]
         self.vehicle_zone = vehicle_zone
         self.safety_radius = safety_radius  # m
-        self.prediction_length = prediction_length
-        self.prediction_step = prediction_step
+        self._prediction_length = prediction_length
+        self._prediction_step = prediction_step
+        self._update_path_coefs()
+
+    @property
+    def dt(self):
+        return self._dt
+
+    @dt.setter
+    def dt(self, dt: float):
+        # Process noise is constant for the time step
+        self._dt = dt
+        self.Q = Q_matrix(dt)
+
+    @property
+    def prediction_length(self):
+        return self._prediction_length
+
+    @prediction_length.setter
+    def prediction_length(self, length: float):
+        self._prediction_length = length
+        self._update_path_coefs()
+
+    @property
+    def prediction_step(self):
+        return self._prediction_step
+
+    @prediction_step.setter
+    def prediction_step(self, step: float):
+        self._prediction_step = step
+        self._update_path_coefs()
+
+    def _update_path_coefs(self):
+        # Path coefficients and the path buffer depend on the prediction settings
+        self.path_coefs = path_coefficients(self._prediction_length, self._prediction_step)
+        self.paths = np.zeros((self.means.shape[0], self.path_coefs.shape[0], 2), dtype=np.float32)  # (N,M,2) Buffer for future paths
 
     @staticmethod
     def from_dict(d):
@@ -169,28 +322,86 @@ class ForwardCollisionGuard:
         Update state of objects tracked in world space
         """
         # Sync world trackers with image trackers
-        for tid in list(self.objects.keys()):
-            if tid not in ref_points:
-                self.objects.pop(tid)
-                logging.info(f"Tracking of {tid} lost")
-
-        for tid in ref_points.keys():
-            if tid not in self.objects:
-                logging.info("Tracking object {tid}".format(tid=tid))
-                self.objects[tid] = PointWorldObject(ref_points[tid], self.dt)
-            else:
-                self.objects[tid].update(ref_points[tid][:2])
+        lost = [tid for tid in self.tid_to_row if tid not in ref_points]
+        for tid in lost:
+            self.objects.pop(tid)
+            self.free_rows.append(self.tid_to_row.pop(tid))
+            logging.info(f"Tracking of {tid} lost")
+
+        if not ref_points: return
+
+        # Rows of objects - new objects get free rows
+        tids = list(ref_points.keys())
+        is_new = np.fromiter((tid not in self.tid_to_row for tid in tids), dtype=bool, count=len(tids))
+        for i in np.flatnonzero(is_new):
+            logging.info("Tracking object {tid}".format(tid=tids[i]))
+            self._add(tids[i])
+        rows = np.fromiter((self.tid_to_row[tid] for tid in tids), dtype=np.intp, count=len(tids))
+        z = np.asarray(list(ref_points.values()), dtype=np.float32)[:, :2, np.newaxis]  # (N,2,1)
+
+        # Initialize new objects at the measured location
+        new_rows = rows[is_new]
+        self.means[new_rows] = 0
+        self.means[new_rows[:, np.newaxis], [0, 3]] = z[is_new]
+        self.covs[new_rows] = P0
+        self.updated[new_rows] = False
+        self.distances[new_rows] = np.inf
+
+        # Predict and update all tracked objects at once
+        tracked = ~is_new
+        if tracked.any():
+            tracked_rows = rows[tracked]
+            R = covariance(z[tracked, :, 0], sigma=0.1, scale=0.1).astype(np.float32)
+            kf_predict_update_batched(self.means, self.covs, tracked_rows, z[tracked], self.dt, self.Q, R)
+            self.updated[tracked_rows] = True
+            # Distances are used repeatedly until the next update
+            self.distances[tracked_rows] = np.hypot(self.means[tracked_rows, 0, 0], self.means[tracked_rows, 3, 0])
+
+    def _add(self, tid):
+        """
+        Assign a free row to a new object
+        """
+        if not self.free_rows:
+            # Grow the state arrays geometrically
+            n = self.means.shape[0]
+            self.free_rows = list(range(2 * n - 1, n - 1, -1))
+            self.means = np.concatenate([self.means, np.zeros_like(self.means)])
+            self.covs = np.concatenate([self.covs, np.zeros_like(self.covs)])
+            self.updated = np.concatenate([self.updated, np.zeros_like(self.updated)])
+            self.distances = np.concatenate([self.distances, np.full_like(self.distances, np.inf)])
+            self.paths = np.concatenate([self.paths, np.zeros_like(self.paths)])
+        self.tid_to_row[tid] = self.free_rows.pop()
+        self.objects[tid] = PointWorldObject(self, tid)
 
     def dangerous_objects(self):
         """
         Check future paths of objects and filter dangerous ones
         """
-        return {
-            tid: obj for tid, obj in self.objects.items()
-            if obj.distance < self.safety_radius and obj.future_path(
-                self.prediction_length, self.prediction_step
-            ).intersects(self.danger_zone)
-        }
+        tids = list(self.tid_to_row.keys())
+        rows = np.fromiter(self.tid_to_row.values(), dtype=np.intp, count=len(tids))
+
+        # Objects in safety radius - distance of objects without a measurement is inf
+        idx_live = np.flatnonzero(self.distances[rows] < self.safety_radius)
+        rows = rows[idx_live]
+        n = rows.size
+        paths = future_paths(self.means[rows], self.path_coefs, out=self.paths[:n])  # (n,M,2)
+
+        # Bounding boxes of paths settle most objects without calling GEOS
+        dz_min, dz_max = self.danger_zone_bounds
+        path_min, path_max = paths.min(1), paths.max(1)  # (n,2)
+        outside = np.any((path_max < dz_min) | (path_min > dz_max), axis=1)
+        inside = np.all((path_min >= dz_min) & (path_max <= dz_max), axis=1)
+
+        # Paths starting in the zone
+        dangerous = inside & ~outside
+        idx = np.flatnonzero(dangerous)
+        dangerous[idx] = shapely.contains_xy(self.danger_zone, paths[idx, 0, 0], paths[idx, 0, 1])
+        # Intersect the rest with the zone regions in one query
+        idx = np.flatnonzero(~outside & ~dangerous)
+        line_idx, _ = self.zone_tree.query(shapely.linestrings(paths[idx]), predicate="intersects")
+        dangerous[idx[line_idx]] = True
+
+        return {tids[i]: self.objects[tids[i]] for i in idx_live[dangerous]}
 
     def label_objects(
             self,
@@ -199,16 +410,17 @@ class ForwardCollisionGuard:
         """
         Check future paths of objects and filter dangerous ones
         """
-        for tid, obj in self.objects.items():
-            if obj.xy is None: continue
+        for tid, row in self.tid_to_row.items():
+            if not self.updated[row]: continue
 
-            loc = Point(obj.location)
+            x, y = self.means[row, [0, 3], 0]
+            loc = Point(x, y)
             dist = loc.distance(self.vehicle_zone)
             
             if dist > self.safety_radius and not include_distant:
                 continue
 
-            path = obj.future_path(self.prediction_length, self.prediction_step)
+            path = LineString(future_paths(self.means[row:row + 1], self.path_coefs)[0])
             collision_point_distance = intersection_point(path, self.vehicle_zone.boundary)
             if collision_point_distance is not None:
                 ttc = (collision_point_distance / path.length) * self.prediction_length
@@ -219,7 +431,7 @@ class ForwardCollisionGuard:
                 distance=dist,
                 location=loc,
                 path=path,
-                is_in_danger_zone=self.danger_zone.contains(loc),
+                is_in_danger_zone=bool(shapely.contains_xy(self.danger_zone, x, y)),
                 crosses_danger_zone=path.crosses(self.danger_zone),
                 time_to_collision=ttc,
             )
@@ -108,8 +108,10 @@ if __name__ == "__main__":
             t.id: t for t in tracker.trackers
             if t.hit_streak > tracker.min_hits and t.time_since_update < 1 and t.age > 3
         }
+        # Bounding boxes of tracked objects (N,4)
+        boxes = np.array([t.get_state()[0] for t in tracked_objects.values()]).reshape(-1, 4)
         # Get 3D locations of objects
-        ref_pt = get_reference_points(tracked_objects, camera, is_rectified=True)
+        ref_pt = get_reference_points(list(tracked_objects.keys()), boxes, camera, is_rectified=True)
         # Update state of objects in world
         guard.update(ref_pt)
         # Get list of current offenses
@@ -53,6 +53,7 @@ class Camera:
         self.K_new = estimateCameraMatrix(
             self.K, self.D, self.image_size, np.eye(3), new_size=self.rectified_size, fov_scale=1.2
         )
+        self.K_new_inv = inv(self.K_new)
         self.maps = initUndistortRectifyMap(self.K, self.D, np.eye(3), self.K_new, self.rectified_size, cv2.CV_32F)
 
         # view_direction = d.get("view_direction", "x")
@@ -89,7 +90,7 @@ class Camera:
         """
         n = x.shape[0]
         x = np.vstack([x.T, np.ones((1,n))]).astype(np.float32)
-        x_norm = inv(self.K_new) @ x 
+        x_norm = self.K_new_inv @ x 
         y = distortPoints(x_norm.reshape(1,-1,2), self.K, self.D)
         return y[0]
 
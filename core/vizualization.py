@@ -83,14 +83,14 @@ def draw_world_objects(
         
     for o in objects:
         
-        X = np.atleast_2d([o.kf.x[0,0],o.kf.x[3,0],0])
+        X = np.atleast_2d([*o.x[[0,3],0],0])
         scr_loc, _ = camera.project_points(X)
         if scr_loc.size > 0:
             x,y = scr_loc[0]
             draw.line([(x-10,y),(x+10,y)], fill=(255,255,0,128), width=3)
             draw.line([(x,y-10),(x,y+10)], fill=(255,255,0,128), width=3)
 
-        X = np.array(o.future_path(5).coords)
+        X = o.future_path_xy(5)
         n = X.shape[0]
         X = np.hstack([X, np.zeros((n,1))])
         scr_loc, _ = camera.project_points(X,near=5)
@@ -218,7 +218,7 @@ def mark_vehicles(size: tuple, objects:Iterable[PointWorldObject], camera: Camer
     ax,ay = anchor
     # loc (N,2) xy
     for o in objects:
-        X = np.atleast_2d([o.kf.x[0,0],o.kf.x[3,0],0])
+        X = np.atleast_2d([*o.x[[0,3],0],0])
         scr_loc, _ = camera.project_points(X, near=1, to_rectified=False)
         if scr_loc.shape[0] > 0:
             x,y = scr_loc[0]
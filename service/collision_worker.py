@@ -43,8 +43,10 @@ class CollisionWorker(Worker, ImageDetector):
             t.id: t for t in self.tracker.trackers
             if t.hit_streak > self.tracker.min_hits and t.time_since_update < 1
         }
+        # Bounding boxes of tracked objects (N,4)
+        boxes = np.array([t.get_state()[0] for t in tracked_objects.values()]).reshape(-1, 4)
         # Get 3D locations of objects
-        ref_points = get_reference_points(tracked_objects, self.camera, is_rectified=True)
+        ref_points = get_reference_points(list(tracked_objects.keys()), boxes, self.camera, is_rectified=True)
         # Update state of objects in world
         self.guard.update(ref_points)
 
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules in core/ import each other by plain module names
+sys.path.insert(0, str(Path(__file__).parents[1] / "core"))
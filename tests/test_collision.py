@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from filterpy.common import Q_discrete_white_noise
+from filterpy.kalman import KalmanFilter
+
+from collision import P0, ForwardCollisionGuard, Q_matrix, covariance, kf_predict_update_batched
+from shapely.geometry import box
+
+DT = 1 / 30
+
+
+def filterpy_tracker(xy, dt):
+    """
+    Per-object filter as it was implemented with filterpy
+    """
+    kf = KalmanFilter(dim_x=6, dim_z=2)
+    dt2 = 0.5 * dt ** 2
+    kf.F = np.array(
+        [[1, dt, dt2, 0, 0, 0],
+         [0, 1, dt, 0, 0, 0],
+         [0, 0, 1, 0, 0, 0],
+         [0, 0, 0, 1, dt, dt2],
+         [0, 0, 0, 0, 1, dt],
+         [0, 0, 0, 0, 0, 1]]
+    )
+    kf.H = np.array(
+        [[1, 0, 0, 0, 0, 0],
+         [0, 0, 0, 1, 0, 0]]
+    )
+    kf.P = np.diag([1, 2, 400, 1, 2, 400]) * 10.0
+    kf.Q = Q_discrete_white_noise(dim=3, dt=dt, var=0.5e-1**2, block_size=2)
+    kf.x[0], kf.x[3] = xy
+    return kf
+
+
+def measurements(n_objects=5, n_steps=60, seed=0):
+    """
+    Noisy (0.2 m) locations (n_steps, n_objects, 2) of objects moving at constant speed
+    """
+    rng = np.random.default_rng(seed)
+    start = rng.uniform([5, -10], [40, 10], (n_objects, 2))
+    speed = rng.uniform(-15, 15, (n_objects, 2))
+    t = np.arange(n_steps)[:, None, None] * DT
+    return start + t * speed + rng.normal(0, 0.2, (n_steps, n_objects, 2))
+
+
+# Tolerance (rtol, atol) of the state and covariance against float64 filterpy
+TOLERANCE = {
+    np.float64: (1e-7, 1e-8),
+    np.float32: (1e-4, 1e-3),
+}
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("noise", ["covariance", "constant"])
+@pytest.mark.parametrize("n_steps", [16, 61])
+def test_kf_predict_update_batched_matches_filterpy(dtype, noise, n_steps):
+    z = measurements(n_steps=n_steps)
+    n = z.shape[1]
+    trackers = [filterpy_tracker(xy, DT) for xy in z[0]]
+    means = np.zeros((n, 6, 1), dtype=dtype)
+    means[:, [0, 3], 0] = z[0]
+    covs = np.repeat(P0[np.newaxis], n, axis=0).astype(dtype)
+    rows = np.arange(n)
+    Q = Q_matrix(DT).astype(dtype)
+
+    for zk in z[1:]:
+        R = covariance(zk) if noise == "covariance" else np.repeat([np.eye(2) * 0.2 ** 2], n, axis=0)
+        kf_predict_update_batched(means, covs, rows, zk[..., np.newaxis].astype(dtype), DT, Q, R.astype(dtype))
+        for kf, xy, r in zip(trackers, zk, R):
+            kf.predict()
+            kf.update(xy, R=r)
+
+    rtol, atol = TOLERANCE[dtype]
+    for kf, x, P in zip(trackers, means, covs):
+        np.testing.assert_allclose(x, kf.x, rtol=rtol, atol=atol)
+        np.testing.assert_allclose(P, kf.P, rtol=rtol, atol=atol)
+
+
+def test_guard_young_tracks_match_filterpy():
+    z = measurements(n_steps=16)
+    guard = ForwardCollisionGuard(danger_zone=box(2, -2, 20, 2), vehicle_zone=box(-2, -1, 2, 1), dt=DT)
+    trackers = [filterpy_tracker(xy, DT) for xy in z[0]]
+
+    guard.update({tid: xy for tid, xy in enumerate(z[0])})
+    for zk in z[1:]:
+        guard.update({tid: xy for tid, xy in enumerate(zk)})
+        for kf, xy in zip(trackers, zk):
+            kf.predict()
+            kf.update(xy, R=covariance(xy))
+
+    for tid, kf in enumerate(trackers):
+        np.testing.assert_allclose(guard.objects[tid].x, kf.x, *TOLERANCE[np.float32])
+
+
+def test_lost_object_has_no_location():
+    guard = ForwardCollisionGuard(danger_zone=box(2, -2, 20, 2), vehicle_zone=box(-2, -1, 2, 1), dt=DT)
+    guard.update({1: np.array([5.0, 0.0, 0.0])})
+    guard.update({1: np.array([5.1, 0.0, 0.0])})
+    obj = guard.objects[1]
+    assert obj.xy is not None and obj.distance < np.inf
+
+    guard.update({2: np.array([8.0, 1.0, 0.0])})
+    assert obj.x is None and obj.xy is None and obj.vxvy is None
+    assert obj.distance == np.inf and obj.future_path_xy() is None
+
+
+def test_prediction_settings_change_paths():
+    guard = ForwardCollisionGuard(danger_zone=box(2, -2, 20, 2), vehicle_zone=box(-2, -1, 2, 1), dt=DT)
+    for k in range(10):
+        guard.update({1: np.array([30.0 - 15 * k * DT, 0.0, 0.0])})
+
+    guard.prediction_length = 2
+    assert guard.path_coefs.shape[0] == 21
+    status, = guard.label_objects()
+    np.testing.assert_allclose(status.path.coords, guard.objects[1].future_path_xy(2, 0.1), rtol=1e-6)
+    guard.dangerous_objects()
+    assert guard.paths.shape[1] == 21
+
+    guard.prediction_step = 0.5
+    status, = guard.label_objects()
+    assert len(status.path.coords) == 5
+    guard.dangerous_objects()
+    assert guard.paths.shape[1] == 5